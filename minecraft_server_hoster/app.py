@@ -1,16 +1,54 @@
-from flask import Flask, render_template, jsonify, request, send_from_directory
+# Patch blocking stdlib I/O before anything else imports it, so requests are served concurrently
+from gevent import monkey
+monkey.patch_all()
+
+import gevent
+from flask import Flask, render_template, jsonify, request, send_file
 import os
-from werkzeug.utils import secure_filename
+from streaming_form_data import StreamingFormDataParser
+from flask_caching import Cache
+from flask.json.provider import JSONProvider
+from flask.helpers import get_debug_flag
+import orjson
 # Updated import to reflect __init__.py
 # Now handler includes create_backup, and file_manager is separate
 from server_management import handler, file_manager 
 
+class OrJSONProvider(JSONProvider):
+    """
+    JSON provider backed by orjson, which encodes much faster than the stdlib json.
+    The polled endpoints (status, console log, file list) go through it via jsonify.
+    """
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrJSONProvider(app)
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})
 
 # Configure Upload Folder
 UPLOAD_FOLDER_NAME = 'uploads' # Relative to app.py's directory for simplicity here
 app.config['UPLOAD_FOLDER'] = os.path.abspath(os.path.join(os.path.dirname(__file__), UPLOAD_FOLDER_NAME))
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+if not os.path.isdir(app.config['UPLOAD_FOLDER']):
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+UPLOAD_CHUNK_SIZE = 64 * 1024 # Bytes read from request.stream per parser call
+
+def _etag_json(etag, **payload):
+    """
+    Returns 304 Not Modified if the client already has `etag`, otherwise the JSON payload tagged with it.
+    """
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(**payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache' # Always revalidate, the 304 makes that cheap
+    return response
 
 @app.route('/')
 def home():
@@ -35,21 +73,10 @@ def stop_server_route():
 
 @app.route('/restart_server', methods=['POST'])
 def restart_server_route():
-    stop_result = handler.stop_server()
-    if stop_result.get("status") == "error" and "not running" not in stop_result.get("message", ""):
-        # If stopping failed for a reason other than "not running", report error
-        return jsonify(status="error", message=f"Failed to stop server for restart: {stop_result.get('message')}")
-
-    # Proceed to start, potentially after a short delay
-    # import time
-    # time.sleep(2) # Give it a moment if needed
-
-    # Assuming default start parameters for now
-    start_result = handler.start_server() 
-    if start_result.get("status") == "success":
-        return jsonify(status="success", message="Server restarting...")
-    else:
-        return jsonify(status="error", message=f"Server stopped, but failed to start: {start_result.get('message')}")
+    # Stop and start happen under the handler's lock, so the start proceeds as soon as
+    # the old process has exited. Assuming default start parameters for now
+    result = handler.restart_server()
+    return jsonify(result)
 
 
 @app.route('/send_command', methods=['POST'])
@@ -66,8 +93,12 @@ def get_console_log_route():
     # server_dir_name = request.args.get('server_dir_name', handler.DEFAULT_SERVER_DIR_NAME)
     # lines = request.args.get('lines', 50, type=int)
     # log_content = handler.read_console_log(server_dir_name, lines)
+    # The version is taken before reading, so a tag can only ever be older than the content
+    etag = handler.console_log_version()
+    if request.if_none_match.contains(etag):
+        return _etag_json(etag)
     log_content = handler.read_console_log() # Using defaults for now
-    return jsonify(status="success", log=log_content)
+    return _etag_json(etag, status="success", log=log_content)
 
 @app.route('/get_server_status', methods=['GET'])
 def get_server_status_route():
@@ -79,34 +110,44 @@ def get_server_status_route():
 
 @app.route('/upload_file', methods=['POST'])
 def upload_file_route():
-    if 'file' not in request.files:
+    # The body is parsed straight off request.stream so the file is written chunk by chunk
+    # next to its final location (and renamed into place once complete), instead of being
+    # spooled to a temp file and copied. request.files/request.form must not be touched
+    # here, or Werkzeug consumes the stream.
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+    except Exception:
         return jsonify(status="error", message="No file part"), 400
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify(status="error", message="No selected file"), 400
-    
-    subdir = request.form.get('subdir', '') # e.g. server_name/plugins
-    # For now, basic upload to UPLOAD_FOLDER. Subdir logic would be in handler.
-    
-    # filename = secure_filename(file.filename)
-    # destination_path = os.path.join(app.config['UPLOAD_FOLDER'], subdir, filename)
-    # os.makedirs(os.path.dirname(destination_path), exist_ok=True)
-    
-    # Placeholder call - actual saving logic will be in handler.handle_upload
-    # For this step, we assume handler.handle_upload will take the file object
-    # and the *intended final filename/subdir within a managed area*.
-    # Let's simplify the call for now, assuming handler takes care of secure_filename and path construction.
-    
-    # This is a conceptual call, actual implementation of handler.handle_upload will determine exact params.
-    # For now, let's assume it takes the file stream and the desired filename, and an optional subdir within its managed space.
-    s_filename = secure_filename(file.filename) # Still good to secure it here before passing
-    
-    # Call the new handler function
-    result = file_manager.handle_upload(
-        file_storage=file, 
-        destination_folder=app.config['UPLOAD_FOLDER'], 
-        sub_directory=subdir
+
+    # subdir can also come from the query string, e.g. ?subdir=server_name/plugins
+    upload = file_manager.register_upload_targets(
+        parser,
+        destination_folder=app.config['UPLOAD_FOLDER'],
+        sub_directory=request.args.get('subdir', '')
     )
+
+    try:
+        while True:
+            chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            parser.data_received(chunk)
+    except Exception as e:
+        upload.abort()
+        return jsonify(status="error", message=f"Upload failed: {str(e)}"), 500
+
+    if upload.multipart_filename is None:
+        return jsonify(status="error", message="No file part"), 400
+    if upload.multipart_filename == '':
+        return jsonify(status="error", message="No selected file"), 400
+    if not upload.finished:
+        upload.abort()
+        return jsonify(status="error", message="Upload incomplete."), 400
+    if upload.subdir_ignored:
+        upload.abort()
+        return jsonify(status="error", message="The 'subdir' field must be sent before 'file'."), 400
+
+    result = upload.result()
     
     if result.get("status") == "success":
         return jsonify(status="success", message=result.get("message"), filename=result.get("filename"), path=result.get("path"))
@@ -123,10 +164,16 @@ def download_file_route(filename):
     target_file_abs_path = file_manager.prepare_download_path(app.config['UPLOAD_FOLDER'], filename)
     
     if target_file_abs_path:
-        # send_from_directory needs directory and the filename part
-        directory_part = os.path.dirname(target_file_abs_path)
-        filename_part = os.path.basename(target_file_abs_path)
-        return send_from_directory(directory_part, filename_part, as_attachment=True)
+        # The path is already validated, so hand it straight to send_file. conditional=True
+        # adds Range/If-None-Match handling (resumable downloads), and the WSGI server's
+        # wsgi.file_wrapper streams the file without copying it through the app.
+        return send_file(
+            target_file_abs_path,
+            as_attachment=True,
+            conditional=True,
+            etag=True,
+            last_modified=os.path.getmtime(target_file_abs_path)
+        )
     else:
         return jsonify(status="error", message="File not found or access denied."), 404
 
@@ -136,10 +183,11 @@ def list_files_route():
     path_param = request.args.get('path', '') # Relative path within UPLOAD_FOLDER
     
     # Path traversal is handled by list_files_in_directory
-    result = file_manager.list_files_in_directory(app.config['UPLOAD_FOLDER'], path_param)
+    result = file_manager.list_files_in_directory(app.config['UPLOAD_FOLDER'], path_param, cache=cache)
     
     if result.get("status") == "success":
-        return jsonify(
+        return _etag_json(
+            result.get("etag"),
             status="success", 
             files=result.get("files"), 
             directories=result.get("directories"), 
@@ -152,22 +200,29 @@ def list_files_route():
 def backup_server_route():
     # server_dir_name could be a parameter from request.json if supporting multiple instances
     # For now, assume default:
-    # Assuming create_backup is now part of the handler module as per previous steps
-    result = handler.create_backup(server_dir_name="default_server") 
-    if result.get("status") == "success":
-        return jsonify(result)
-    else:
-        # Consider more specific error codes if known (e.g., 404 if instance not found)
-        return jsonify(result), 500 # Internal Server Error for backup failure
+    server_dir_name = "default_server"
+    job_id = handler.create_backup_job(server_dir_name)
+    if job_id is None:
+        return jsonify(status="error", message="A backup of this server is already running."), 409
+    # Runs as a greenlet: tar/pigz is waited on cooperatively, and the zip fallback
+    # yields between files. (Not the native threadpool: gevent can't wait on
+    # child processes from those threads.)
+    gevent.spawn(handler.run_backup_job, job_id, server_dir_name)
+    return jsonify(status="accepted", job_id=job_id, message="Backup started."), 202
 
+@app.route('/backup_status/<job_id>', methods=['GET'])
+def backup_status_route(job_id):
+    job = handler.get_backup_job(job_id)
+    if job is None:
+        return jsonify(status="error", message="Unknown backup job."), 404
+    return jsonify(job_id=job_id, **job)
 
-if __name__ == '__main__':
-    # This is important for relative imports if you run app.py directly
-    # For production, you'd use a WSGI server like Gunicorn
-    # from minecraft_server_hoster.server_management import handler
-    
-    # Create a dummy server script for local testing if it doesn't exist
-    # This is just for convenience when running app.py directly
+
+def _ensure_dev_server():
+    """
+    Creates a dummy server script for local testing if it doesn't exist.
+    Only called when app.py is run directly, never when imported by a WSGI server.
+    """
     dummy_script_name = "dummy_server.sh"
     dummy_script_path = os.path.join(handler.DEFAULT_SERVER_PATH, dummy_script_name)
     if not os.path.exists(dummy_script_path):
@@ -195,4 +250,18 @@ if __name__ == '__main__':
         os.chmod(dummy_script_path, 0o755) # Make it executable
         # No longer need to import os here as it's at the top
 
-    app.run(host='0.0.0.0', port=5000, debug=True)
+
+if __name__ == '__main__':
+    # This is important for relative imports if you run app.py directly
+    # Served by gevent's WSGIServer so uploads, backups and log polls don't block each other.
+    # Set FLASK_DEBUG=1 to use the Werkzeug dev server with the debugger instead.
+    # from minecraft_server_hoster.server_management import handler
+    
+    _ensure_dev_server()
+
+    if get_debug_flag(): # Same parsing as Flask: FLASK_DEBUG=0/false/no stays off
+        # Werkzeug's dev server, with the debugger and reloader
+        app.run(host='0.0.0.0', port=5000, debug=True)
+    else:
+        from gevent.pywsgi import WSGIServer
+        WSGIServer(('0.0.0.0', 5000), app).serve_forever()
@@ -1,12 +1,14 @@
 # In minecraft_server_hoster/server_management/__init__.py
 from .handler import (
-    start_server, stop_server, get_server_status, 
-    read_console_log, send_minecraft_command,
-    create_backup # Added create_backup
+    start_server, stop_server, restart_server, get_server_status, is_running,
+    read_console_log, console_log_version, send_minecraft_command,
+    create_backup, # Added create_backup
+    create_backup_job, run_backup_job, get_backup_job
 )
-from .file_manager import handle_upload, list_files_in_directory, prepare_download_path
+from .file_manager import resolve_upload_path, register_upload_targets, list_files_in_directory, prepare_download_path
 
 __all__ = [
-    'start_server', 'stop_server', 'get_server_status', 'read_console_log', 'send_minecraft_command', 'create_backup',
-    'handle_upload', 'list_files_in_directory', 'prepare_download_path'
+    'start_server', 'stop_server', 'restart_server', 'get_server_status', 'is_running', 'read_console_log', 'console_log_version', 'send_minecraft_command', 'create_backup',
+    'create_backup_job', 'run_backup_job', 'get_backup_job',
+    'resolve_upload_path', 'register_upload_targets', 'list_files_in_directory', 'prepare_download_path'
 ]
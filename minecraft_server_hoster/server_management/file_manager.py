@@ -1,63 +1,201 @@
 import os
-import shutil
+import uuid
+from streaming_form_data.targets import FileTarget, ValueTarget
 from werkzeug.utils import secure_filename
 
-def handle_upload(file_storage, destination_folder, sub_directory=""):
+LIST_CACHE_TIMEOUT = 60 # Seconds a cached directory listing is kept
+
+# Path components dropped from client-supplied subdirectories
+_BAD_PARTS = {'..', ''}
+
+def _path_parts(p):
+    """
+    Splits a client-supplied relative path on both '/' and '\\' separators.
+    """
+    return p.replace('\\', '/').split('/')
+
+def _safe_parts(p):
+    """
+    Returns the components of p with '..' and empty components removed.
+    """
+    return [x for x in _path_parts(p) if x not in _BAD_PARTS]
+
+# base_path -> resolved absolute path. The base folders are fixed at app start,
+# so they are only normalized once instead of on every request.
+_ABS_CACHE = {}
+
+def _abs_base(base_path):
+    """
+    Returns the cached, symlink-resolved absolute path of a base folder.
+    """
+    abs_path = _ABS_CACHE.get(base_path)
+    if abs_path is None:
+        abs_path = _ABS_CACHE[base_path] = os.path.realpath(base_path)
+    return abs_path
+
+def _is_within(child, parent):
+    """
+    Checks that child resolves to parent or a path below it.
+
+    Symlinks in child are resolved first, so a link pointing outside parent is
+    rejected. parent must already be a resolved absolute path (see _abs_base).
+    Paths that can't be resolved (e.g. containing a null byte) are rejected too.
+    """
+    try:
+        return os.path.commonpath([os.path.realpath(child), parent]) == parent
+    except ValueError:
+        return False
+
+class UploadFileTarget(FileTarget):
     """
-    Handles file uploads, saving the file to a specified destination.
+    A FileTarget that resolves its destination only once the part headers are parsed.
+
+    The final path depends on the client-supplied filename (and an optional
+    ``subdir`` form field, which must be sent before the file), so it cannot be
+    known when the target is registered. Chunks are streamed into a temporary
+    ``.<name>.<id>.part`` file next to the destination, which only replaces the
+    destination once the request body has been fully and validly parsed.
+    """
+
+    def __init__(self, destination_folder, sub_directory="", subdir_target=None):
+        super().__init__(None)
+        self.destination_folder = destination_folder
+        self.sub_directory = sub_directory
+        self.subdir_target = subdir_target
+        self.final_path = None
+        self.error = None
+        self._used_subdir_field = False
+
+    def on_start(self):
+        if not self.multipart_filename:
+            return # No file selected in the form, nothing to write
+
+        sub_directory = self.sub_directory
+        if self.subdir_target is not None and self.subdir_target.value:
+            sub_directory = self.subdir_target.value.decode('utf-8', 'replace')
+            self._used_subdir_field = True
+
+        self.final_path = resolve_upload_path(self.destination_folder, sub_directory, self.multipart_filename)
+        if not self.final_path:
+            self.error = "Invalid filename."
+            return
+
+        target_dir, name = os.path.split(self.final_path)
+        self.filename = os.path.join(target_dir, f".{name}.{uuid.uuid4().hex[:8]}.part")
+        try:
+            os.makedirs(target_dir, exist_ok=True)
+            super().on_start()
+        except OSError as e:
+            self.filename = None
+            self.final_path = None
+            self.error = f"Could not save file: {str(e)}"
+
+    @property
+    def finished(self):
+        """True once the parser has seen the end of the file part (its closing boundary)."""
+        return self._finished
+
+    @property
+    def subdir_ignored(self):
+        """True if a 'subdir' field arrived only after the file had already been placed without it."""
+        return (self.final_path is not None and not self._used_subdir_field
+                and self.subdir_target is not None and bool(self.subdir_target.value))
+
+    def abort(self):
+        """Closes and removes the temporary file; the destination file is left untouched."""
+        if self._fd:
+            self._fd.close()
+            self._fd = None
+        if self.filename and os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.filename = None
+
+    def result(self):
+        """
+        Moves the completed upload into place once the request body has been fully parsed.
+
+        Returns:
+            A dictionary with status and message.
+        """
+        if self.error:
+            self.abort()
+            return {"status": "error", "message": self.error}
+        if not self.multipart_filename or not self.final_path:
+            self.abort()
+            return {"status": "error", "message": "No file provided or filename is empty."}
+        if not self.finished:
+            self.abort()
+            return {"status": "error", "message": "Upload incomplete."}
+        try:
+            os.replace(self.filename, self.final_path)
+        except OSError as e:
+            self.abort()
+            return {"status": "error", "message": f"Could not save file: {str(e)}"}
+        self.filename = None
+        return {"status": "success",
+                "message": "File uploaded successfully.",
+                "filename": os.path.basename(self.final_path),
+                "path": os.path.relpath(self.final_path, self.destination_folder)} # Return relative path
+
+def resolve_upload_path(destination_folder, sub_directory, filename):
+    """
+    Builds a sanitized destination path for an uploaded file.
 
     Args:
-        file_storage: The FileStorage object from request.files.
         destination_folder: The base folder for uploads.
         sub_directory: Optional subdirectory path to append to destination_folder.
+        filename: The filename as supplied by the client.
 
     Returns:
-        A dictionary with status and message.
-    """
-    if file_storage and file_storage.filename:
-        filename = secure_filename(file_storage.filename)
-        
-        # Ensure sub_directory is relative and secure
-        # For example, split by '/' or '\' and rejoin, disallowing '..'
-        safe_sub_directory_parts = []
-        if sub_directory:
-            parts = sub_directory.split(os.sep)
-            for part in parts:
-                if part == "..": # Disallow path traversal
-                    continue
-                safe_sub_directory_parts.append(part)
-        safe_sub_directory = os.path.join(*safe_sub_directory_parts) if safe_sub_directory_parts else ""
-
-        target_path_directory = os.path.join(destination_folder, safe_sub_directory)
-        target_path_file = os.path.join(target_path_directory, filename)
+        The full path to write the file to, or None if the filename is invalid.
+    """
+    filename = secure_filename(filename or "")
+    if not filename:
+        return None
 
-        try:
-            os.makedirs(target_path_directory, exist_ok=True)
-            file_storage.save(target_path_file)
-            return {"status": "success", 
-                    "message": "File uploaded successfully.", 
-                    "filename": filename, 
-                    "path": os.path.relpath(target_path_file, destination_folder)} # Return relative path
-        except Exception as e:
-            return {"status": "error", "message": f"Could not save file: {str(e)}"}
-    else:
-        return {"status": "error", "message": "No file provided or filename is empty."}
+    # Ensure sub_directory is relative and secure: split by '/' or '\' and rejoin, disallowing '..'
+    safe_sub_directory_parts = _safe_parts(sub_directory) if sub_directory else []
+    safe_sub_directory = os.path.join(*safe_sub_directory_parts) if safe_sub_directory_parts else ""
+
+    target_path_directory = os.path.join(destination_folder, safe_sub_directory)
+    return os.path.join(target_path_directory, filename)
+
+def register_upload_targets(parser, destination_folder, sub_directory=""):
+    """
+    Registers the targets for an upload form on a StreamingFormDataParser.
+
+    Args:
+        parser: The StreamingFormDataParser built from the request headers.
+        destination_folder: The base folder for uploads.
+        sub_directory: Subdirectory to use if the form does not send a 'subdir' field.
+
+    Returns:
+        The UploadFileTarget for the 'file' field; call its result() after parsing.
+    """
+    subdir_target = ValueTarget()
+    file_target = UploadFileTarget(destination_folder, sub_directory, subdir_target)
+    parser.register('subdir', subdir_target)
+    parser.register('file', file_target)
+    return file_target
 
-def list_files_in_directory(base_path, sub_path=""):
+def list_files_in_directory(base_path, sub_path="", cache=None):
     """
     Lists files and directories within a given path, with security checks.
 
     Args:
         base_path: The root directory to list from.
         sub_path: The relative path within base_path to list.
+        cache: Optional flask_caching.Cache. Listings are cached per directory mtime,
+            so an unchanged directory is served without re-reading it.
 
     Returns:
-        A dictionary with status, files, directories, and current_path.
+        A dictionary with status, files, directories, current_path, and etag
+        (derived from the directory's mtime and size; changes when entries do).
     """
-    abs_base_path = os.path.abspath(base_path)
+    abs_base_path = _abs_base(base_path)
     current_path_to_return = sub_path 
 
-    if os.path.isabs(sub_path) or ".." in sub_path.split(os.sep):
+    if os.path.isabs(sub_path) or ".." in _path_parts(sub_path):
         if sub_path: 
             return {"status": "error", "message": "Access denied. Invalid path."}
         # If sub_path is empty and valid (e.g. just ""), it means list base_path
@@ -69,15 +207,36 @@ def list_files_in_directory(base_path, sub_path=""):
         # current_path_to_return remains sub_path
 
     # Final security check: ensure the resolved target_dir is within abs_base_path
-    if not target_dir.startswith(abs_base_path):
+    if not _is_within(target_dir, abs_base_path):
         return {"status": "error", "message": "Access denied. Attempted path traversal."}
 
     if os.path.exists(target_dir) and os.path.isdir(target_dir):
         try:
-            items = os.listdir(target_dir)
-            files = [item for item in items if os.path.isfile(os.path.join(target_dir, item))]
-            directories = [item for item in items if os.path.isdir(os.path.join(target_dir, item))]
-            return {"status": "success", "files": files, "directories": directories, "current_path": current_path_to_return}
+            # Adding/removing an entry bumps the directory mtime, which changes the etag
+            # and invalidates the cache key
+            dir_stat = os.stat(target_dir)
+            etag = f"{dir_stat.st_mtime_ns}-{dir_stat.st_size}"
+            cache_key = None
+            if cache is not None:
+                cache_key = f"ls:{target_dir}:{etag}"
+                cached = cache.get(cache_key)
+                if cached is not None:
+                    files, directories = cached
+                    return {"status": "success", "files": files, "directories": directories, "current_path": current_path_to_return, "etag": etag}
+
+            # DirEntry caches the entry type from the directory read, so no extra stat per item
+            files = []
+            directories = []
+            with os.scandir(target_dir) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        directories.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+
+            if cache_key is not None:
+                cache.set(cache_key, (files, directories), timeout=LIST_CACHE_TIMEOUT)
+            return {"status": "success", "files": files, "directories": directories, "current_path": current_path_to_return, "etag": etag}
         except OSError as e:
             return {"status": "error", "message": f"Error listing directory: {str(e)}"}
     else:
@@ -94,11 +253,11 @@ def prepare_download_path(base_download_folder, requested_filename):
     Returns:
         The full, validated path to the file, or None if invalid/not found.
     """
-    abs_base_download_folder = os.path.abspath(base_download_folder)
+    abs_base_download_folder = _abs_base(base_download_folder)
 
     # Ensure requested_filename is not absolute and does not contain '..' (path traversal)
     # Also, disallow empty filenames.
-    if not requested_filename or os.path.isabs(requested_filename) or ".." in requested_filename.split(os.sep):
+    if not requested_filename or os.path.isabs(requested_filename) or ".." in _path_parts(requested_filename):
         return None
 
     # Construct the naive path
@@ -107,7 +266,7 @@ def prepare_download_path(base_download_folder, requested_filename):
     full_path = os.path.abspath(full_path)
 
     # Security Check: Ensure the normalized full_path is still within the base_download_folder
-    if not full_path.startswith(abs_base_download_folder):
+    if not _is_within(full_path, abs_base_download_folder):
         return None 
 
     if os.path.exists(full_path) and os.path.isfile(full_path):
@@ -1,11 +1,38 @@
 import subprocess
 import os
 import shutil
+import collections
+import threading
+import signal
 import time
 import datetime
+import uuid
+import zipfile
+import dataclasses
 
 # --- Global Variables (Conceptual for a single server instance for now) ---
-SERVER_PROCESS = None
+@dataclasses.dataclass
+class _ServerHandle:
+    """
+    The running server process together with the resources that live and die with it.
+    """
+    proc: subprocess.Popen
+    # Last lines of the server's stdout/stderr, filled by the reader thread
+    buf: collections.deque
+    # Drains proc.stdout into buf; exits when the process closes its output
+    reader: threading.Thread
+
+# The current server, or None. Only replaced while holding _LOCK.
+_HANDLE = None
+# Serializes start/stop/restart so a restart can't interleave with another start or stop.
+# Module-level rather than per handle, since it also guards creating the handle.
+_LOCK = threading.RLock()
+# Total number of lines ever read from any server's output; never reset, so it identifies buffer contents
+_CONSOLE_SEQ = 0
+# Cached "server is running" flag, so status polls don't each cost a waitpid() syscall.
+# Refreshed on SIGCHLD and when the reader thread sees the process exit; None means unknown.
+_RUNNING = False
+CONSOLE_BUF_LINES = 2000 # Lines of server output kept in memory for the console
 
 # Base directory for all server instances
 BASE_SERVER_INSTANCES_DIR = os.path.abspath("minecraft_server_hoster/server_instances")
@@ -16,13 +43,14 @@ DEFAULT_SERVER_PATH = os.path.join(BASE_SERVER_INSTANCES_DIR, DEFAULT_SERVER_DIR
 DEFAULT_LOGS_DIR = os.path.join(DEFAULT_SERVER_PATH, "logs")
 
 # Ensure the default server directory and its logs subdirectory exist
-os.makedirs(DEFAULT_SERVER_PATH, exist_ok=True)
-os.makedirs(DEFAULT_LOGS_DIR, exist_ok=True)
+# (checked first so already-initialized workers don't issue mkdir calls on import)
+if not os.path.isdir(DEFAULT_LOGS_DIR):
+    os.makedirs(DEFAULT_LOGS_DIR, exist_ok=True) # Also creates DEFAULT_SERVER_PATH
 
 # --- Server Management Functions ---
 
 def start_server(jar_file="server.jar", server_dir_name=DEFAULT_SERVER_DIR_NAME, memory_mb=1024):
-    global SERVER_PROCESS
+    global _HANDLE, _RUNNING
 
     server_path = os.path.join(BASE_SERVER_INSTANCES_DIR, server_dir_name)
     jar_path = os.path.join(server_path, jar_file)
@@ -34,109 +62,213 @@ def start_server(jar_file="server.jar", server_dir_name=DEFAULT_SERVER_DIR_NAME,
     if not os.path.exists(jar_path):
         return {"status": "error", "message": f"Server JAR not found at {jar_path}."}
 
-    if SERVER_PROCESS is None or SERVER_PROCESS.poll() is not None:
-        if jar_path.endswith(".jar"):
-            command = ["java", f"-Xmx{memory_mb}M", f"-Xms{memory_mb}M", "-jar", jar_path, "nogui"]
-        else: # Assume it's an executable script for our dummy server
-            command = [jar_path]
+    with _LOCK:
+        if _HANDLE is not None and _HANDLE.proc.poll() is None:
+            return {"status": "error", "message": "Server is already running."}
+        if _HANDLE is not None: # Exited on its own; release what it still holds
+            _release_handle(_HANDLE)
+            _HANDLE = None
+
+        command = _build_command(jar_path, memory_mb)
         
         try:
-            # Note: For live console streaming to web UI, this needs more sophisticated handling (e.g., threads, websockets)
-            # For now, stdout/stderr go to files or can be read via SERVER_PROCESS.stdout if needed by another function.
-            # The actual latest.log will be written by the Minecraft server itself.
-            SERVER_PROCESS = subprocess.Popen(
+            # stdout/stderr are drained by a reader thread into the handle's buffer, so the
+            # pipe never fills up and stalls the server. The actual latest.log will be
+            # written by the Minecraft server itself.
+            proc = subprocess.Popen(
                 command,
                 cwd=server_path,
                 stdin=subprocess.PIPE,
                 stdout=subprocess.PIPE, # Capture output
                 stderr=subprocess.STDOUT, # Redirect stderr to stdout
-                text=True,
-                bufsize=1, # Line buffered
-                universal_newlines=True,
+                # Binary pipes: the reader thread decodes each line itself, instead of a
+                # line-buffered text wrapper (bufsize=1 with text mode) doing it per write
+                text=False,
                 # stderr=subprocess.PIPE # Keep separate for initial error check
             )
-            # Quick check for immediate errors (optional, for debugging)
-            # time.sleep(0.5) # Give it a fraction of a second
-            # if SERVER_PROCESS.poll() is not None:
-            #     out, err = SERVER_PROCESS.communicate()
-            #     error_message = f"Server process terminated immediately. stdout: {out}, stderr: {err}"
-            #     SERVER_PROCESS = None # Clear it
-            #     return {"status": "error", "message": error_message}
-                
-            return {"status": "success", "message": f"Server starting in {server_path}..."}
         except Exception as e:
             return {"status": "error", "message": f"Failed to start server: {str(e)}"}
-    else:
-        return {"status": "error", "message": "Server is already running."}
+
+        buf = collections.deque(maxlen=CONSOLE_BUF_LINES)
+        reader = threading.Thread(target=_pump_output, args=(proc, buf), daemon=True)
+        _HANDLE = _ServerHandle(proc=proc, buf=buf, reader=reader)
+        _RUNNING = None # A SIGCHLD may have raced the assignment above, poll on first use
+        reader.start()
+        # Quick check for immediate errors (optional, for debugging)
+        # time.sleep(0.5) # Give it a fraction of a second
+        # if proc.poll() is not None:
+        #     error_message = f"Server process terminated immediately. output: {''.join(buf)}"
+        #     return {"status": "error", "message": error_message}
+            
+        return {"status": "success", "message": f"Server starting in {server_path}..."}
+
+def _build_command(jar_path, memory_mb):
+    """
+    Returns the command used to launch the server at jar_path.
+    """
+    if jar_path.endswith(".jar"):
+        return ("java", f"-Xmx{memory_mb}M", f"-Xms{memory_mb}M", "-jar", jar_path, "nogui")
+    # Assume it's an executable script for our dummy server
+    return (jar_path,)
+
+def _pump_output(proc, buf):
+    """
+    Copies the server's output into buf line by line until the pipe closes.
+    """
+    global _CONSOLE_SEQ
+    for raw in iter(proc.stdout.readline, b''):
+        buf.append(raw.decode('utf-8', 'replace'))
+        _CONSOLE_SEQ += 1
+    proc.stdout.close()
+    proc.wait()
+    _update_running_state()
+
+def _release_handle(handle):
+    """
+    Joins the reader thread and closes stdin of a server process that has exited.
+    """
+    handle.reader.join(timeout=5) # EOF follows the exit unless a child still holds the pipe
+    try:
+        handle.proc.stdin.close()
+    except OSError:
+        pass # Broken pipe flushing leftover input to a dead process
+
+def _update_running_state(*_):
+    """
+    Refreshes _RUNNING from the current server process. Also used as the SIGCHLD handler.
+    """
+    global _RUNNING
+    handle = _HANDLE
+    _RUNNING = handle is not None and handle.proc.poll() is None
+
+def is_running():
+    """
+    Returns whether the server process is running, using the cached flag when it is known.
+    """
+    if _RUNNING is None:
+        _update_running_state()
+    return _RUNNING
+
+# SIGCHLD only exists on POSIX, and handlers can only be installed from the main thread
+if hasattr(signal, "SIGCHLD"):
+    try:
+        signal.signal(signal.SIGCHLD, _update_running_state)
+    except ValueError:
+        pass
 
 def stop_server():
-    global SERVER_PROCESS
-    if SERVER_PROCESS and SERVER_PROCESS.poll() is None: # Server is running
+    global _HANDLE
+    with _LOCK:
+        handle = _HANDLE
+        if handle is None or handle.proc.poll() is not None:
+            if handle is not None: # Ensure it's cleared if it was found to be not running
+                _release_handle(handle)
+                _HANDLE = None
+            _update_running_state()
+            return {"status": "error", "message": "Server is not running."}
+
+        proc = handle.proc
         try:
-            SERVER_PROCESS.stdin.write("stop\n")
-            SERVER_PROCESS.stdin.flush()
+            proc.stdin.write(b"stop\n")
+            proc.stdin.flush()
         except Exception as e:
             # Handle broken pipe if process died unexpectedly
             print(f"Error sending 'stop' command: {e}. Forcing termination.")
 
-        # Wait for graceful shutdown
-        for _ in range(10): # Try for 10 seconds
-            if SERVER_PROCESS.poll() is not None:
-                break
-            time.sleep(1)
-        
-        if SERVER_PROCESS.poll() is None: # Still running
+        # Wait for graceful shutdown; wait() returns as soon as the process exits
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired: # Still running
             print("Server did not stop gracefully, terminating...")
-            SERVER_PROCESS.terminate()
-            time.sleep(5) # Wait for termination
-            if SERVER_PROCESS.poll() is None: # Still running
+            proc.terminate()
+            try:
+                proc.wait(timeout=5) # Wait for termination
+            except subprocess.TimeoutExpired: # Still running
                 print("Server did not terminate, killing...")
-                SERVER_PROCESS.kill()
+                proc.kill()
+                proc.wait()
         
-        SERVER_PROCESS = None
+        _release_handle(handle)
+        _HANDLE = None
+        _update_running_state()
         return {"status": "success", "message": "Server stopped."}
-    else:
-        SERVER_PROCESS = None # Ensure it's None if it was found to be not running
-        return {"status": "error", "message": "Server is not running."}
+
+def restart_server(**start_kwargs):
+    """
+    Stops the server (if running) and starts it again with start_kwargs, atomically.
+
+    The start proceeds as soon as the old process has exited and its reader is joined.
+    """
+    with _LOCK:
+        stop_result = stop_server()
+        if stop_result.get("status") == "error" and "not running" not in stop_result.get("message", ""):
+            # If stopping failed for a reason other than "not running", report error
+            return {"status": "error", "message": f"Failed to stop server for restart: {stop_result.get('message')}"}
+
+        start_result = start_server(**start_kwargs)
+        if start_result.get("status") == "success":
+            return {"status": "success", "message": "Server restarting..."}
+        else:
+            return {"status": "error", "message": f"Server stopped, but failed to start: {start_result.get('message')}"}
 
 def get_server_status():
-    global SERVER_PROCESS
-    if SERVER_PROCESS:
-        poll_result = SERVER_PROCESS.poll()
-        if poll_result is None:
+    handle = _HANDLE
+    if handle is not None:
+        if is_running():
             return "running"
         else:
-            output = ""
-            try:
-                # Attempt to read any output the process might have generated before exiting
-                # stdout is a pipe, read non-blockingly or with timeout if possible,
-                # but communicate() is simpler for a one-off after process termination.
-                # SERVER_PROCESS.stdout is TextIOWrapper, so it's text.
-                # communicate() should be called only once.
-                if hasattr(SERVER_PROCESS, '_communicated'): # crude check if communicated before
-                     output = "[already communicated]"
-                elif SERVER_PROCESS.stdout:
-                    # stdout_data, stderr_data = SERVER_PROCESS.communicate(timeout=1) # timeout helps prevent hangs
-                    # output = f"stdout: {stdout_data}, stderr: {stderr_data}"
-                    # For now, let's assume stdout contains merged output due to stderr=subprocess.STDOUT
-                    stdout_data = SERVER_PROCESS.stdout.read() # This might be empty if already read
-                    output = f"output: {stdout_data}"
-                    SERVER_PROCESS._communicated = True # mark it
-            except Exception as e:
-                output = f"[Error reading output: {str(e)}]"
-            
-            # SERVER_PROCESS = None # It's stopped, clear it for next start
-            return f"stopped (exit code: {poll_result}, {output})"
+            # The output is not read here: the reader thread owns stdout, see _ServerHandle.buf
+            return f"stopped (exit code: {handle.proc.poll()})"
     return "stopped"
 
 
 # --- Backup Management ---
 BACKUPS_DIR = os.path.abspath("minecraft_server_hoster/backups")
-os.makedirs(BACKUPS_DIR, exist_ok=True)
+if not os.path.isdir(BACKUPS_DIR):
+    os.makedirs(BACKUPS_DIR, exist_ok=True)
+
+# Multi-core compressors used for tar backups, in order of preference:
+# (binary to look up, program passed to tar -I, archive extension)
+TAR_COMPRESSORS = (
+    ("pigz", "pigz", ".tar.gz"),
+    ("zstd", "zstd -T0 -3", ".tar.zst"),
+)
+
+def _find_tar_compressor():
+    """
+    Returns the (program, extension) of the first available multi-core compressor, or None.
+    """
+    if not shutil.which("tar"):
+        return None
+    for binary, program, extension in TAR_COMPRESSORS:
+        if shutil.which(binary):
+            return program, extension
+    return None
+
+def _write_zip_archive(archive_full_path, root_dir_for_archive, server_instance_path):
+    """
+    Writes server_instance_path to an uncompressed (stored) zip archive.
+    """
+    with zipfile.ZipFile(archive_full_path, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for root, dirs, files in os.walk(server_instance_path):
+            # Directory entries keep empty directories in the backup
+            arc_root = os.path.relpath(root, root_dir_for_archive)
+            zf.write(root, arcname=arc_root)
+            # root comes normalized from os.walk, so per-file paths are plain concatenations
+            # instead of an os.path.join + os.path.relpath per file
+            for name in files:
+                zf.write(f"{root}{os.sep}{name}", arcname=f"{arc_root}{os.sep}{name}")
+                # File I/O never yields on its own; give other greenlets/threads a turn between files
+                time.sleep(0)
 
 def create_backup(server_dir_name="default_server", backup_base_name="backup"):
     """
-    Creates a zip backup of the specified server instance directory.
+    Creates a backup of the specified server instance directory.
+
+    If pigz or zstd is installed, the backup is a tar archive compressed on all
+    cores (.tar.gz / .tar.zst). Otherwise it falls back to a zip with files
+    stored uncompressed: world region files and JARs are already compressed, so
+    single-threaded deflate costs a lot of CPU for almost no space.
     """
     server_instance_path = os.path.join(BASE_SERVER_INSTANCES_DIR, server_dir_name)
 
@@ -145,70 +277,149 @@ def create_backup(server_dir_name="default_server", backup_base_name="backup"):
 
     timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     backup_filename_stem = f"{backup_base_name}-{server_dir_name}-{timestamp}"
-    # archive_path_without_ext is where shutil will place the archive.
-    # shutil.make_archive automatically adds the extension (e.g., .zip)
-    archive_path_name_for_shutil = os.path.join(BACKUPS_DIR, backup_filename_stem)
+    compressor = _find_tar_compressor()
+    extension = compressor[1] if compressor else ".zip"
+    archive_full_path = os.path.join(BACKUPS_DIR, backup_filename_stem + extension)
 
     try:
-        # root_dir should be the parent of the directory we want to archive.
-        # base_dir is the name of the directory to archive.
+        # Archive members are relative to the parent of the instance directory,
+        # so the archive contains the instance directory itself.
         # Example: to archive server_instances/default_server,
-        # root_dir = server_instances
-        # base_dir = default_server
-        
+        # root_dir_for_archive = server_instances
+        # base_dir_to_archive = default_server
         root_dir_for_archive = os.path.dirname(server_instance_path)
         base_dir_to_archive = os.path.basename(server_instance_path)
 
-        # shutil.make_archive returns the full path to the created archive
-        archive_full_path = shutil.make_archive(
-            base_name=archive_path_name_for_shutil, 
-            format='zip', 
-            root_dir=root_dir_for_archive,
-            base_dir=base_dir_to_archive
-        )
+        if compressor:
+            tar_command = ["tar", "-I", compressor[0], "-cf", archive_full_path, "-C", root_dir_for_archive, base_dir_to_archive]
+            completed = subprocess.run(tar_command, capture_output=True)
+            # GNU tar exits with 1 for "file changed as we read it", which a running server
+            # causes all the time; the archive is still usable. Only 2+ is a real failure.
+            if completed.returncode >= 2:
+                raise subprocess.CalledProcessError(completed.returncode, tar_command, completed.stdout, completed.stderr)
+        else:
+            _write_zip_archive(archive_full_path, root_dir_for_archive, server_instance_path)
         
-        actual_backup_filename = os.path.basename(archive_full_path) # e.g., backup-default_server-20231027-123456.zip
+        actual_backup_filename = os.path.basename(archive_full_path) # e.g., backup-default_server-20231027-123456.tar.gz
         
         return {"status": "success", 
                 "message": f"Backup created: {actual_backup_filename}", 
                 "backup_file": actual_backup_filename}
+    except subprocess.CalledProcessError as e:
+        _remove_partial_archive(archive_full_path)
+        error_output = e.stderr.decode('utf-8', 'replace').strip() if e.stderr else str(e)
+        return {"status": "error", "message": f"Backup creation failed: {error_output}"}
     except Exception as e:
+        _remove_partial_archive(archive_full_path)
         return {"status": "error", "message": f"Backup creation failed: {str(e)}"}
 
+def _remove_partial_archive(archive_full_path):
+    """
+    Deletes an archive left behind by a failed backup.
+    """
+    try:
+        if os.path.exists(archive_full_path):
+            os.remove(archive_full_path)
+    except OSError:
+        pass
+
+
+# --- Backup Jobs ---
+# Backups started through create_backup_job(), by job id. Each entry holds the
+# latest status dict: "running" while the archive is written, then the result
+# of create_backup().
+JOBS = {}
+# server_dir_name -> id of its running backup job. Archives are named by timestamp only,
+# so two concurrent backups of one instance would write (and clean up) the same file.
+_ACTIVE_BACKUPS = {}
+_JOBS_LOCK = threading.Lock()
+
+def create_backup_job(server_dir_name="default_server"):
+    """
+    Registers a new backup job and returns its id. The caller runs it with run_backup_job().
+
+    Returns None if a backup of server_dir_name is already running.
+    """
+    with _JOBS_LOCK:
+        if server_dir_name in _ACTIVE_BACKUPS:
+            return None
+        job_id = uuid.uuid4().hex
+        _ACTIVE_BACKUPS[server_dir_name] = job_id
+        JOBS[job_id] = {"status": "running", "message": f"Backup of '{server_dir_name}' in progress."}
+    return job_id
+
+def run_backup_job(job_id, server_dir_name="default_server", backup_base_name="backup"):
+    """
+    Runs create_backup() and records its result under job_id.
+    """
+    try:
+        JOBS[job_id] = create_backup(server_dir_name, backup_base_name)
+    finally:
+        with _JOBS_LOCK:
+            if _ACTIVE_BACKUPS.get(server_dir_name) == job_id:
+                del _ACTIVE_BACKUPS[server_dir_name]
+    return JOBS[job_id]
+
+def get_backup_job(job_id):
+    """
+    Returns the status dict of a backup job, or None if the id is unknown.
+    """
+    return JOBS.get(job_id)
+
+
+def console_log_version(server_dir_name=DEFAULT_SERVER_DIR_NAME, lines=50):
+    """
+    Returns a tag that changes whenever read_console_log() would return different content.
+    Cheap to compute (no log read), so it can back an HTTP ETag.
+    """
+    handle = _HANDLE
+    if handle is not None and handle.buf:
+        return f"buf-{_CONSOLE_SEQ}-{lines}"
+
+    log_path = os.path.join(BASE_SERVER_INSTANCES_DIR, server_dir_name, "logs", "latest.log")
+    try:
+        log_stat = os.stat(log_path)
+    except OSError:
+        return f"missing-{lines}"
+    return f"file-{log_stat.st_mtime_ns}-{log_stat.st_size}-{lines}"
 
 def read_console_log(server_dir_name=DEFAULT_SERVER_DIR_NAME, lines=50):
+    # Prefer the output captured from the server process, which needs no disk I/O
+    handle = _HANDLE
+    if handle is not None and handle.buf:
+        return "".join(list(handle.buf)[-lines:])
+
     log_path = os.path.join(BASE_SERVER_INSTANCES_DIR, server_dir_name, "logs", "latest.log")
     
     if os.path.exists(log_path):
         try:
-            with open(log_path, 'r') as f:
-                log_lines = f.readlines()
+            # Only read the tail of the file: start with a window of ~200 bytes per line
+            # and double it until it holds more than `lines` newlines (or the whole file).
+            # lines <= 0 reads the whole file, matching the old readlines()[-lines:] slice.
+            with open(log_path, 'rb') as f:
+                fsize = os.fstat(f.fileno()).st_size
+                block = lines * 200 if lines > 0 else fsize
+                while True:
+                    offset = max(0, fsize - block)
+                    f.seek(offset)
+                    data = f.read(fsize - offset)
+                    if data.count(b'\n') > lines or offset == 0:
+                        break
+                    block *= 2
+            log_lines = data.decode('utf-8', 'replace').splitlines(keepends=True)
             return "".join(log_lines[-lines:])
         except Exception as e:
             return f"Error reading log file: {str(e)}"
     else:
-        # Check if the server process itself has any output (e.g. if server failed before creating latest.log)
-        # This is a very basic way to get some output if latest.log isn't there yet.
-        # A better system would pipe Popen's stdout to a file AND to a live stream.
-        if SERVER_PROCESS and SERVER_PROCESS.stdout:
-            # Non-blocking read attempt - this is not robust for continuous logging
-            # For a real scenario, a separate thread would read SERVER_PROCESS.stdout
-            try:
-                # This is just a snapshot, not a live log.
-                # And reading directly from PIPE like this can be problematic.
-                # For now, we are mostly relying on latest.log
-                return "Log file not found, and live process output reading is not fully implemented here. Check server directory."
-            except Exception as e:
-                return f"Log file not found. Error attempting to read process stdout: {str(e)}"
         return "Log file not found."
 
 
-def send_minecraft_command(command, server_dir_name=DEFAULT_SERVER_DIR_NAME): # server_dir_name not used yet with single SERVER_PROCESS
-    global SERVER_PROCESS
-    if SERVER_PROCESS and SERVER_PROCESS.poll() is None:
+def send_minecraft_command(command, server_dir_name=DEFAULT_SERVER_DIR_NAME): # server_dir_name not used yet with a single server handle
+    handle = _HANDLE
+    if handle is not None and handle.proc.poll() is None:
         try:
-            SERVER_PROCESS.stdin.write(command + "\n")
-            SERVER_PROCESS.stdin.flush()
+            handle.proc.stdin.write((command + "\n").encode('utf-8'))
+            handle.proc.stdin.flush()
             return {"status": "success", "message": f"Command '{command}' sent."}
         except Exception as e:
             return {"status": "error", "message": f"Failed to send command: {str(e)}"}
@@ -126,13 +126,15 @@ document.addEventListener('DOMContentLoaded', () => {
                 return;
             }
             const formData = new FormData();
-            formData.append('file', file);
             
-            // Example for subdir - you might get this from another input
+            // Example for subdir - you might get this from another input.
+            // It must be appended before 'file': the server streams the file to disk
+            // as it arrives, so it needs to know the destination first.
             // const subdirValue = document.getElementById('uploadSubdirInput')?.value;
             // if (subdirValue) {
             //     formData.append('subdir', subdirValue);
             // }
+            formData.append('file', file);
 
             const data = await fetchData('/upload_file', {
                 method: 'POST',
@@ -218,7 +220,17 @@ document.addEventListener('DOMContentLoaded', () => {
             
             alert('Starting backup... This might take a moment.'); // Give immediate feedback
 
-            const data = await fetchData('/backup_server', { method: 'POST' });
+            const job = await fetchData('/backup_server', { method: 'POST' });
+            if (!job || !job.job_id) {
+                return;
+            }
+
+            // The backup runs in the background; poll its job until it finishes
+            let data = job;
+            while (data && (data.status === 'accepted' || data.status === 'running')) {
+                await new Promise(resolve => setTimeout(resolve, 2000));
+                data = await fetchData(`/backup_status/${encodeURIComponent(job.job_id)}`);
+            }
             if (data) {
                 alert(data.message || 'Backup request processed.');
                 // Optionally, refresh a list of backups if displayed on the page